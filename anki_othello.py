@@ -1,73 +1,288 @@
+import os
+import pickle
 import re
+import select
 import subprocess
-import sys
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
-import requests
-
 # ---------- CONFIG ----------
 EDAX_DIRECTORY = "../edax"
 EDAX_FILENAME = "lEdax-x86-64"
+EDAX_LEVEL = 30
+EDAX_PROMPT = ">" # printed at the start of a line whenever EDAX waits for the next command
+EDAX_TIMEOUT = 600 # seconds of silence before EDAX is considered hung and restarted
 EVAL_SWING_THRESHOLD = 5 # points difference to count as a blunder
+ANKI_CONNECT_URL = "http://127.0.0.1:8765"
+EVAL_CACHE_FILE = Path(__file__).with_name("edax_eval_cache.pkl")
 # ----------------------------
 
-def run_edax(play_command):
-    """Send commands to EDAX and return output."""
-    proc = subprocess.Popen(
-        [f"./{EDAX_FILENAME}"],
-        cwd=EDAX_DIRECTORY,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    # Only request the best move
-    out, err = proc.communicate("level 30\n" + play_command + "hint 1\n")
-
-    if err:
-        print("EDAX error:", err.strip())
+_HINT_PATTERN = r"\d+@\d+%[ \t]+([+-]?\d+).*?[ \t]([A-Ha-h][1-8])"
+_HINT_RE = re.compile(_HINT_PATTERN)
+_HINT_STREAM_RE = re.compile(_HINT_PATTERN.encode()) # same pattern, for raw EDAX output
+_MOVE_RE = re.compile(r"\b[A-H][1-8]\b", re.IGNORECASE)
+_PROMPT_RE = re.compile(rb"(?m)^" + re.escape(EDAX_PROMPT.encode()))
+
+# One keep-alive connection to AnkiConnect for the whole run, created on first use
+_ANKI = None
+# AnkiConnect version, set once it has answered so later requests skip the check
+_ANKI_VERSION = None
+
+# Keeps the multi-line move reports of parallel workers from interleaving
+_PRINT_LOCK = threading.Lock()
+# Set on Ctrl-C so workers stop instead of restarting the EDAXes the terminal interrupted
+_STOPPING = threading.Event()
+
+# Runs the AFTER search of each move while the worker itself runs the BEFORE search
+_SEARCH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+# (best move, eval) per position, keyed by the move sequence reaching it; persisted across runs
+_EVAL_CACHE = {}
+
+
+def anki_session():
+    """Return the shared AnkiConnect session, importing requests only when it is needed."""
+    global _ANKI
+    if _ANKI is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _ANKI = requests.Session()
+        _ANKI.headers.update({"Content-Type": "application/json"})
+        _ANKI.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return _ANKI
 
+
+def check_anki_connect():
+    """Return True if AnkiConnect answers, pinging it only until it first does."""
+    global _ANKI_VERSION
+    if _ANKI_VERSION is not None:
+        return True
     try:
-        proc.kill()
+        resp = anki_session().post(ANKI_CONNECT_URL, json={"action": "version", "version": 6}, timeout=5)
     except Exception:
-        pass
-
-    return out
+        print("Could not connect to AnkiConnect. Please ensure Anki is running with AnkiConnect installed.")
+        return False
+    try:
+        version = resp.json()["result"] if resp.ok else None
+    except (ValueError, KeyError, TypeError):
+        # Not JSON, or not AnkiConnect's reply shape: something else is listening on the port
+        version = None
+    if version is None:
+        print("AnkiConnect is not responding properly. Please ensure Anki is running with AnkiConnect installed.")
+        return False
+    _ANKI_VERSION = version
+    return True
+
+
+class EdaxError(Exception):
+    """EDAX hung or died before answering a query."""
+
+
+class EdaxSession:
+    """Long-lived EDAX process that answers hint queries over stdin/stdout."""
+
+    def __init__(self, n_tasks=None):
+        self.n_tasks = n_tasks # EDAX search threads; EDAX uses every core when None
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _start(self):
+        args = [f"./{EDAX_FILENAME}"]
+        if self.n_tasks is not None:
+            args += ["-n", str(self.n_tasks)]
+        # EDAX cannot save its transposition table to disk; keeping the process alive keeps it across queries
+        self.proc = subprocess.Popen(
+            args,
+            cwd=EDAX_DIRECTORY,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        self.moves = None # position EDAX currently holds, None if unknown
+        self._buf = b"" # output read but not yet consumed
+        # EDAX prompts once at startup and once after each command; these are the ones not read yet
+        self._unread_prompts = 1
+        self._send(f"level {EDAX_LEVEL}\n")
+
+    def _restart(self):
+        self.proc.kill()
+        self.proc.wait()
+        self._start()
+
+    def _send(self, commands):
+        """Write commands straight to EDAX's stdin, in as few syscalls as the pipe allows."""
+        self._unread_prompts += commands.count("\n")
+        data = commands.encode()
+        fd = self.proc.stdin.fileno()
+        while data:
+            data = data[os.write(fd, data):]
+
+    def _read_reply(self):
+        """Read EDAX output up to the prompt that follows the last command sent.
+
+        Returns the hint result line seen on the way, or None if there was none.
+        Raises EdaxError if EDAX stays silent for EDAX_TIMEOUT or exits.
+        """
+        fd = self.proc.stdout.fileno()
+        hint = None
+        scan_from = 0
+        while True:
+            # Each prompt closes the output of one command; look for the hint in it
+            while self._unread_prompts:
+                m = _PROMPT_RE.search(self._buf, scan_from)
+                if not m:
+                    break
+                hint_m = _HINT_STREAM_RE.search(self._buf, 0, m.start())
+                if hint_m:
+                    hint = hint_m.group(0).decode(errors="replace")
+                self._buf = self._buf[m.end():]
+                self._unread_prompts -= 1
+                scan_from = 0
+            if not self._unread_prompts:
+                return hint
+            # The prompt starts a line, so only the unfinished last line needs rescanning
+            scan_from = self._buf.rfind(b"\n") + 1
+
+            if not select.select([fd], [], [], EDAX_TIMEOUT)[0]:
+                raise EdaxError("EDAX timed out")
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise EdaxError("EDAX exited unexpectedly")
+            self._buf += chunk
+
+    def _commands_for(self, moves):
+        if self.moves is not None and moves[:len(self.moves)] == self.moves:
+            # EDAX keeps its board between commands, so only send what is new
+            new_moves = moves[len(self.moves):]
+            commands = ""
+        else:
+            new_moves = moves
+            commands = "init\n"
+        if new_moves:
+            commands += "play " + " ".join(new_moves) + "\n"
+        return commands + "hint 1\n"
+
+    def query(self, moves):
+        """Return EDAX's hint result for the position reached by `moves`, or None if it gave none.
+
+        If EDAX hangs or dies it is restarted and the query retried once; a second failure raises EdaxError.
+        """
+        moves = list(moves)
+        for _ in range(2):
+            try:
+                self._send(self._commands_for(moves))
+                hint = self._read_reply()
+            except BrokenPipeError:
+                error = EdaxError("EDAX exited unexpectedly")
+            except EdaxError as e:
+                error = e
+            else:
+                # Without a hint (game over, illegal move) EDAX's board may not be what we expect
+                self.moves = moves if hint is not None else None
+                return hint
+            if _STOPPING.is_set():
+                break
+            # A search may still be running; start over rather than read its stale output later
+            print(f"{error}, restarting it.")
+            self._restart()
+        raise error
+
+    def close(self):
+        """Ask EDAX to quit, killing it only if it does not exit in time."""
+        try:
+            self._send("quit\n")
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
 
 def parse_hint_output(output):
     """Parse EDAX output and extract best move and evaluation."""
-    for line in output.splitlines():
-        m = re.match(r".*?\d+@\d+%\s+([+-]?\d+).*?\s([A-Ha-h][1-8])", line)
-        if m:
-            try:
-                score = int(m.group(1))
-            except ValueError:
-                score = None
-            move = m.group(2).upper()
-            return move, score
-    return None, None
+    if not output:
+        return None, None
+    m = _HINT_RE.search(output)
+    if not m:
+        return None, None
+    return m.group(2).upper(), int(m.group(1))
 
 
-def analyze_single_move(before_moves, after_moves):
-    """Analyze a single move (difference between before and after arrays)."""
+def load_eval_cache():
+    """Load evaluations saved by earlier runs, ignoring ones made at another EDAX level."""
+    try:
+        with open(EVAL_CACHE_FILE, "rb") as fh:
+            saved = pickle.load(fh)
+        if not isinstance(saved, dict) or not isinstance(saved.get("evals"), dict):
+            raise ValueError("unexpected format")
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        print(f"Could not read eval cache: {e}")
+        return
+    if saved.get("level") == EDAX_LEVEL:
+        _EVAL_CACHE.update(saved["evals"])
+
+
+def save_eval_cache():
+    # Write a temp file and swap it in, so an interrupted save leaves the old cache intact
+    tmp_path = f"{EVAL_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "wb") as fh:
+            pickle.dump({"level": EDAX_LEVEL, "evals": _EVAL_CACHE}, fh)
+        os.replace(tmp_path, EVAL_CACHE_FILE)
+    except Exception as e:
+        print(f"Could not write eval cache: {e}")
+
+
+def evaluate_position(moves, edax):
+    """Return EDAX's best move and eval for a position, reusing earlier results."""
+    key = tuple(moves)
+    if key not in _EVAL_CACHE:
+        best_move, score = parse_hint_output(edax.query(moves))
+        if best_move is None or score is None:
+            return best_move, score
+        _EVAL_CACHE[key] = (best_move, score)
+    return _EVAL_CACHE[key]
+
+
+def analyze_single_move(before_moves, after_moves, edax_pair):
+    """Analyze a single move (difference between before and after arrays).
+
+    `edax_pair` holds two EDAX sessions so both positions are searched at once.
+    """
     if len(after_moves) != len(before_moves) + 1:
         print("Invalid move file: not exactly one move added.")
         return None
 
     played_move = after_moves[-1]
-    color = "B" if len(before_moves) % 2 == 0 else "W"
-
-    play_cmd_before = ("play " + " ".join(before_moves) + "\n") if before_moves else ""
-    play_cmd_after = "play " + " ".join(after_moves) + "\n"
-
-    # Evaluate best move from BEFORE position
-    raw_before = run_edax(play_cmd_before)
-    best_move_before, eval_best_move = parse_hint_output(raw_before)
-
-    # Evaluate best reply from AFTER position
-    raw_after = run_edax(play_cmd_after)
-    best_reply_after_actual, eval_after_reply = parse_hint_output(raw_after)
+    color = "BW"[len(before_moves) & 1]
+
+    edax_before, edax_after = edax_pair
+    cached_before = _EVAL_CACHE.get(tuple(before_moves))
+    if cached_before is not None and cached_before[0] == played_move:
+        # Playing EDAX's own choice loses nothing, so there is no need to search the AFTER position
+        best_move_before, eval_best_move = cached_before
+        best_reply_after_actual, eval_after_reply = "-", -eval_best_move
+    else:
+        # Evaluate best move from BEFORE position and best reply from AFTER position concurrently
+        fut_after = _SEARCH_POOL.submit(evaluate_position, after_moves, edax_after)
+        try:
+            best_move_before, eval_best_move = evaluate_position(before_moves, edax_before)
+        except BaseException:
+            # Don't hand edax_after to the next move while it is still searching this one
+            wait([fut_after])
+            raise
+        best_reply_after_actual, eval_after_reply = fut_after.result()
 
     if eval_best_move is None or eval_after_reply is None or best_move_before is None or best_reply_after_actual is None:
         print("Could not parse EDAX output properly.")
@@ -85,95 +300,168 @@ def analyze_single_move(before_moves, after_moves):
         "delta": delta,
     }
 
-    print("-" * 72)
-    print(f"Color: {color}, Played: {played_move}")
-    print(f"Eval(best): {eval_best_move:>4}, BestMove: {best_move_before}")
-    print(f"Eval(after reply): {eval_after_reply:>4}, BestReply: {best_reply_after_actual}")
-    print(f"Δ = {delta:+d}")
-    print("-" * 72)
+    with _PRINT_LOCK:
+        print("-" * 72)
+        print(f"Color: {color}, Played: {played_move}")
+        print(f"Eval(best): {eval_best_move:>4}, BestMove: {best_move_before}")
+        print(f"Eval(after reply): {eval_after_reply:>4}, BestReply: {best_reply_after_actual}")
+        print(f"Δ = {delta:+d}")
+        print("-" * 72)
 
     return row
 
 
-def add_anki_card(sequence_fenish, correct_move):
-    ANKI_CONNECT_URL = "http://localhost:8765"
+def add_anki_cards(cards):
+    """Add (sequence, solution) cards to Anki in a single AnkiConnect request.
+
+    Returns the set of cards Anki accepted.
+    """
+    accepted = set()
+    if not check_anki_connect():
+        return accepted
     payload = {
-        "action": "addNote",
+        "action": "addNotes",
         "version": 6,
         "params": {
-            "note": {
-                "deckName": "Othello",
-                "modelName": "Othello",
-                "fields": {
-                    "Sequence": sequence_fenish,
-                    "Solution": correct_move,
-                },
-            }
+            "notes": [
+                {
+                    "deckName": "Othello",
+                    "modelName": "Othello",
+                    "fields": {
+                        "Sequence": sequence_fenish,
+                        "Solution": correct_move,
+                    },
+                }
+                for sequence_fenish, correct_move in cards
+            ]
         },
     }
     try:
-        resp = requests.post(ANKI_CONNECT_URL, json=payload, timeout=5)
-        if resp.ok:
-            print(f"✅ Added card: pos='{sequence_fenish}' -> {correct_move}")
-        else:
-            print(f"⚠️ Failed to add card: {resp.status_code} {resp.text}")
+        resp = anki_session().post(ANKI_CONNECT_URL, json=payload, timeout=5)
+        if not resp.ok:
+            print(f"⚠️ Failed to add cards: {resp.status_code} {resp.text}")
+            return accepted
+        result = resp.json()
+        if result.get("error"):
+            print(f"⚠️ AnkiConnect error: {result['error']}")
+        # One note id per card, or null for the ones Anki rejected
+        note_ids = result.get("result") or [None] * len(cards)
+        for (sequence_fenish, correct_move), note_id in zip(cards, note_ids):
+            if note_id is not None:
+                accepted.add((sequence_fenish, correct_move))
+                print(f"✅ Added card: pos='{sequence_fenish}' -> {correct_move}")
+            else:
+                print(f"⚠️ Failed to add card: pos='{sequence_fenish}' -> {correct_move}")
     except Exception as e:
         print(f"⚠️ Error contacting AnkiConnect: {e}")
+    return accepted
+
+
+def delete_move_file(file_path):
+    try:
+        Path(file_path).unlink()
+        print(f"Deleted move file: {file_path}")
+    except Exception as e:
+        print(f"Could not delete game file: {e}")
 
 
-def process_one_move_file(file_path):
-    """Handle a single .othello file (two-line format)."""
+def process_one_move_file(file_path, edax_pair):
+    """Analyze a single .othello file (two-line format), returning a card to add or None.
+
+    Raises EdaxError if EDAX could not analyze the move. The file is left in place;
+    main deletes it once its card (if any) has reached Anki.
+    """
     text = Path(file_path).read_text().strip()
     lines = [line.strip() for line in text.splitlines() if line.strip()]
 
     if len(lines) != 2:
         print(f"Invalid file format in {file_path}: expected exactly two lines.")
-        return
+        return None
 
-    before_moves = re.findall(r"\b[A-H][1-8]\b", lines[0].upper())
-    after_moves = re.findall(r"\b[A-H][1-8]\b", lines[1].upper())
+    before_moves = [m.upper() for m in _MOVE_RE.findall(lines[0])]
+    after_moves = [m.upper() for m in _MOVE_RE.findall(lines[1])]
 
     if not after_moves:
         print(f"No moves found in {file_path}.")
-        return
+        return None
 
-    row = analyze_single_move(before_moves, after_moves)
+    row = analyze_single_move(before_moves, after_moves, edax_pair)
 
+    card = None
     if row is not None and row["delta"] >= EVAL_SWING_THRESHOLD:
         correct_move = row["best_move_before"]
         if correct_move and correct_move != "-":
             seq_before_str = "".join(before_moves)
-            add_anki_card(seq_before_str, correct_move)
+            card = (seq_before_str, correct_move)
         else:
             print("No valid best move to add as Anki card.")
 
-    # Delete the file once processed
-    try:
-        Path(file_path).unlink()
-        print(f"Deleted move file: {file_path}")
-    except Exception as e:
-        print(f"Could not delete game file: {e}")
+    return card
 
 
 def main():
-    # Check anki is running before proceeding
     try:
-        resp = requests.post("http://localhost:8765", json={"action": "version", "version": 6}, timeout=5)
-        if not resp.ok:
-            print("AnkiConnect is not responding properly. Please ensure Anki is running with AnkiConnect installed.")
-            return
-    except Exception:
-        print("Could not connect to AnkiConnect. Please ensure Anki is running with AnkiConnect installed.")
-        return
-
-    othello_files = sorted(Path.home().joinpath("Downloads").glob("*.othello"))
+        with os.scandir(Path.home() / "Downloads") as entries:
+            othello_files = sorted(e.path for e in entries if e.name.endswith(".othello") and e.is_file())
+    except OSError:
+        # No (readable) downloads folder means there is nothing to process
+        othello_files = []
     if not othello_files:
         print("No .othello files found in the downloads folder.")
         return
 
-    for f in othello_files:
-        print(f"\nProcessing file: {f}")
-        process_one_move_file(f)
+    # Check anki is running before proceeding
+    if not check_anki_connect():
+        return
+
+    load_eval_cache()
+
+    # Files are independent, so spread them over worker threads, each with its own pair of EDAXes
+    worker = threading.local()
+    sessions = []
+
+    def process_in_worker(file_path):
+        if not hasattr(worker, "edax_pair"):
+            pair = []
+            for _ in range(2):
+                pair.append(EdaxSession(n_tasks))
+                sessions.append(pair[-1])
+            worker.edax_pair = tuple(pair)
+        print(f"\nProcessing file: {file_path}")
+        return process_one_move_file(file_path, worker.edax_pair)
+
+    cpus = os.cpu_count() or 1
+    max_workers = min(len(othello_files), max(1, cpus // 2))
+    # EDAX searches on every core by default; split the cores between all sessions instead
+    n_tasks = max(1, cpus // (2 * max_workers))
+    processed = [] # (file, card or None) for every file analyzed without error
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            try:
+                futures = [(f, ex.submit(process_in_worker, f)) for f in othello_files]
+                for f, fut in futures:
+                    try:
+                        processed.append((f, fut.result()))
+                    except Exception as e:
+                        print(f"Could not process {f}, leaving it for the next run: {e}")
+            except BaseException:
+                # Ctrl-C: drop queued files and end in-flight searches so the pool can exit
+                _STOPPING.set()
+                ex.shutdown(wait=False, cancel_futures=True)
+                for edax in list(sessions):
+                    edax.proc.kill()
+                raise
+    finally:
+        for edax in sessions:
+            edax.close()
+        save_eval_cache()
+
+        # Files with a card are only deleted once Anki has it; failed files stay for the next run
+        cards = [card for _, card in processed if card is not None]
+        accepted = add_anki_cards(cards) if cards else set()
+        for f, card in processed:
+            if card is None or card in accepted:
+                delete_move_file(f)
 
 
 if __name__ == "__main__":